@@ -3,11 +3,17 @@ Runs on the RPi that is directly connected to the sensor.
 This file is designed to run only on the RPi that is directly hooked up to the sensor. If it is run as main, it will just parse your arguments and print the sensor response. To get multiple sensor responses, create an SQM() instance from another program.
 """
 
+import os
 import sys
 import time
 import struct
+import glob
 import argparse
+import collections
+import functools
+import selectors
 import threading
+from concurrent import futures
 
 # module import
 import configs_ssh
@@ -32,7 +38,6 @@ le_timeout = configs_ssh.LE_TIMEOUT
 # text encoding
 EOL = configs_ssh.EOL
 utf8 = configs_ssh.utf8
-hex = configs_ssh.hex
 
 # timing
 long_s = configs_ssh.long_s
@@ -44,6 +49,22 @@ if device_type == "SQM-LE":
     import socket
 elif device_type == "SQM-LU":
     import serial
+    import serial.tools.list_ports
+
+# extra serial ports to probe that pyserial may not list (eg. udev links like /dev/ttyUSB_SQMsensor).
+# platform is checked once, at import
+if sys.platform.startswith("linux"):
+    _PORT_PATTERNS = ("/dev/ttyUSB*", "/dev/ttyACM*")
+elif sys.platform == "darwin":
+    _PORT_PATTERNS = ("/dev/tty.usbserial-*",)
+else:  # windows COM ports are all listed by pyserial
+    _PORT_PATTERNS = ()
+
+
+@functools.lru_cache(maxsize=64)
+def _enc(s: str) -> bytes:
+    """Encodes a command. Cached, since the same few commands are sent over and over"""
+    return s.encode(utf8)
 
 
 class SQM:
@@ -55,46 +76,62 @@ class SQM:
         time.sleep(short_s)
         self.start_connection()
 
+    def _register(self) -> None:
+        """Gives the connection its own readiness selector (epoll on the RPi) that wakes the listener when data arrives. Falls back to polling if it can't be selected on"""
+        self.sel = selectors.DefaultSelector()
+        try:
+            self.sel.register(self.s, selectors.EVENT_READ)
+            self.selectable = True
+        except (ValueError, OSError, AttributeError):
+            self.selectable = False  # eg. serial ports on windows
+
+    def _unregister(self) -> None:
+        """Closes the connection's selector"""
+        self.sel.close()
+
+    def _drain(self) -> None:
+        """Reads until the device stops responding, giving up after long_s"""
+        deadline = time.monotonic() + long_s
+        while time.monotonic() < deadline:
+            if not self._read_buffer():
+                break
+
     def _clear_buffer(self) -> None:
         """Clears buffer and prints to console"""
         print("Clearing buffer ... | ", end="", file=sys.stderr)
         print(self._read_buffer(), "| ... DONE", file=sys.stderr)
 
     def send_and_receive(self, s: str, tries: int = tries) -> str:
-        """Sends and receives a single command. called from main
+        """Sends and receives a single command, resetting the connection between attempts. called from main.
+        There's no way to guarantee that the response originated from the command that was sent.
 
         Args:
-            command (str): command to send
-            tries (int, optional): how many attempts to make
+            s (str): command to send
+            tries (int, optional): how many retries to make. Defaults to tries.
 
         Returns:
-            str: sensor response
+            str: sensor response, "" if the sensor never answered
         """
-        m: str = ""
-        self._send_command(s)
-        time.sleep(long_s)
-        byte_m = self._read_buffer()
-        try:  # Sanity check
-            assert byte_m != None
-            m = byte_m.decode(utf8)
-        except:
-            if tries <= 0:
-                print(
-                    ("ERR. Reading the photometer!: %s" % str(byte_m)), file=sys.stderr
-                )
-                if DEBUG:
-                    raise
-                return ""
-            time.sleep(mid_s)
+        byte_m = None
+        for attempt in range(tries + 1):
+            self._send_command(s)
+            time.sleep(long_s)
+            byte_m = self._read_response()
+            if byte_m:
+                return byte_m.decode(utf8, "replace")
+            if attempt == tries:
+                break
+            time.sleep(mid_s * (2**attempt))  # back off before resetting
             self._reset_device()
-            time.sleep(mid_s)
-            m = self.send_and_receive(s, tries - 1)
-            print(("Sensor info: " + str(m)), end=" ", file=sys.stderr)
-        return m
+
+        print(("ERR. Reading the photometer!: %s" % str(byte_m)), file=sys.stderr)
+        if DEBUG:
+            raise ConnectionError(f"No response to {s} after {tries + 1} attempts")
+        return ""
 
     def start_continuous_read(self) -> None:
         """Starts listener"""
-        self.data: list[str] = []
+        self.data: collections.deque[bytes] = collections.deque()
         self.live = True
         self.t1 = threading.Thread(target=self._listen)  # listener in background
         self.t1.start()
@@ -105,20 +142,32 @@ class SQM:
         self.t1.join()
 
     def _listen(self):
-        """Listener. Runs in dedicated thread"""
-        self.live
+        """Listener. Runs in dedicated thread, only reads when the sensor has sent something"""
         while self.live:
-            time.sleep(short_s)
-            self._read_buffer()  # this stores the data
-
-    def _return_collected(self) -> list[str]:
+            if not self.selectable:  # no selector support, poll instead
+                time.sleep(short_s)
+                self._read_buffer()  # this stores the data
+                continue
+            try:
+                ready = self.sel.select(timeout=short_s)  # timeout so self.live is checked
+            except (ValueError, OSError):  # selector closed by a reset, pick up the new one
+                time.sleep(short_s)
+                continue
+            if ready and self._read_buffer() is None:
+                time.sleep(short_s)  # ready but nothing read (eg. closed), don't spin
+
+    def _return_collected(self) -> list[bytes]:
         """Clears data array, returns contents
 
         Returns:
-            list[str]: data to return
+            list[bytes]: data to return
         """
-        d = self.data[:]  # pass by value, not reference
-        self.data.clear()  # clear buffer
+        d = []
+        try:  # popleft is atomic, so nothing the listener appends meanwhile is lost
+            while True:
+                d.append(self.data.popleft())
+        except IndexError:
+            pass
         return d
 
     def rpi_to_client(self, s: str) -> None:
@@ -136,8 +185,7 @@ class SQM:
         Returns:
             list[str]: responses
         """
-        m_arr = self._return_collected()
-        return m_arr
+        return [m.decode(utf8, "replace") for m in self._return_collected()]
 
     def start_connection(self) -> None: ...
 
@@ -145,6 +193,10 @@ class SQM:
 
     def _read_buffer(self) -> bytes | None: ...
 
+    def _read_response(self) -> bytes | None:
+        """Reads the response to a command sent by send_and_receive"""
+        return self._read_buffer()
+
     def _send_command(self, s: str) -> None: ...
 
 
@@ -153,7 +205,7 @@ class SQMLE(SQM):
 
     def __init__(self) -> None:
         """Search the photometer in the network and read its metadata"""
-        self.data: list[str] = []
+        self.data: collections.deque[bytes] = collections.deque()
         try:
             self.addr = device_addr
             self.start_connection()
@@ -167,62 +219,65 @@ class SQMLE(SQM):
             self.start_connection()
         self._clear_buffer()
 
-    def _search(self) -> list[None] | str:
+    def _search(self) -> str:
         """Search SQM LE in the LAN. Return its address"""
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.s.setblocking(False)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
 
         if hasattr(socket, "SO_BROADCAST"):
-            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        # used to be decode, idk why, it needs to be bytes anyways
-        self.s.sendto(
-            "000000f6".encode(hex), ("255.255.255.255", 30718)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.sendto(
+            bytes.fromhex("000000f6"), ("255.255.255.255", 30718)
         )  # no idea why this port is used
-        buf = ""
-        starttime = time.time()
+
+        # wait on replies instead of spinning on recvfrom
+        replies = selectors.DefaultSelector()
+        replies.register(s, selectors.EVENT_READ)
+        deadline = time.monotonic() + 3  # allow all devices time to respond
+        found: list[str] = []
 
         print("Looking for replies; press Ctrl-C to stop.", file=sys.stderr)
-        addr = [None, None]
-        while True:
-            try:
-                (buf, addr) = self.s.recvfrom(30)
-                # BUG: the 3rd hex character probably doesn't correspond to the 3rd bytes character. However, I'm not working with an SQM-LE so I've made the command decision to ignore this.
-                # was buf[3].decode("hex")
-                if buf.decode(hex)[3] == "f7":
-                    # was buf[24:30].encode("hex")
-                    print(
-                        "Received from %s: MAC: %s" % (addr, buf.decode(hex)[24:30]),
-                        file=sys.stderr,
+        try:
+            while (remaining := deadline - time.monotonic()) > 0:
+                if not replies.select(timeout=remaining):
+                    continue
+                while True:  # drain every reply that has arrived
+                    try:
+                        (buf, addr) = s.recvfrom(30)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    if buf[3:4].hex() == "f7":
+                        print(
+                            "Received from %s: MAC: %s" % (addr, buf[24:30].hex()),
+                            file=sys.stderr,
                         )
-            except:
-                # Timeout in seconds. Allow all devices time to respond
-                if time.time() - starttime > 3:
-                    break
-                pass
+                        found.append(str(addr[0]))
+        finally:
+            replies.close()
+            s.close()
 
-        try:
-            assert addr[0] != None
-        except:
+        if not found:
             print("ERR. Device not found!", file=sys.stderr)
-            raise
-        else:
-            return str(addr[0])  # was addr[0]
+            raise ConnectionError("SQM-LE not found on the LAN")
+        return found[0]
 
     def start_connection(self) -> None:
         """Start photometer connection"""
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # commands are tiny request/response messages, don't let Nagle hold them back
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # notice dropped links
         self.s.settimeout(le_timeout)
         self.s.connect((self.addr, int(LE_PORT)))
         # self.s.settimeout(1) # idk why this was commented, I didn't comment it out
+        self._register()
 
     def _close_connection(self) -> None:
         """End photometer connection"""
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
-        request = ""
-        r = True
-        while r:  # wait until device stops responding
-            r = self._read_buffer()
-            request += str(r)
+        self.s.settimeout(0.1)  # don't wait le_timeout on an idle device
+        self._drain()
+        self._unregister()
         self.s.close()
 
     def _read_buffer(self) -> bytes | None:
@@ -230,9 +285,9 @@ class SQMLE(SQM):
         m = None
         try:
             m = self.s.recv(SOCK_BUF)
-            if m.decode(utf8) == "":
+            if not m:
                 return
-            self.data.append(m.decode(utf8).strip())
+            self.data.append(m.strip())
         except:
             pass
         return m
@@ -243,13 +298,13 @@ class SQMLE(SQM):
         Args:
             s (str): the command to send
         """
-        self.s.send(s.encode(utf8))
+        self.s.send(_enc(s))
 
 
 class SQMLU(SQM):
     def __init__(self) -> None:
         """Search for the photometer and read its metadata"""
-        self.data: list[str] = []
+        self.data: collections.deque[bytes] = collections.deque()
         try:
             print(f"Trying fixed device address {device_addr}", file=sys.stderr)
             self.addr = device_addr
@@ -268,99 +323,121 @@ class SQMLU(SQM):
         self._clear_buffer()
 
     def _search(self) -> str:
-        """Photometer search. Name of the port depends on the platform."""
-        ports_unix = ["/dev/ttyUSB" + str(num) for num in range(100)]
-        ports_win = ["COM" + str(num) for num in range(100)]
-
-        os_in_use = sys.platform
+        """Photometer search. Probes every serial port that exists, in parallel."""
+        candidates = [p.device for p in serial.tools.list_ports.comports()]
+        for pattern in _PORT_PATTERNS:
+            candidates += sorted(glob.glob(pattern))
+
+        # skip the address already tried and the LoRa radio, which may be open and mid-stream
+        skip = (device_addr, configs_ssh.R_ADDR, configs_ssh.acc_lora_port)
+        seen = {os.path.realpath(p) for p in skip}
         ports: list[str] = []
-        if os_in_use == "linux2":
-            print("Detected Linux platform", file=sys.stderr)
-            ports = ports_unix
-        elif os_in_use == "win32":
-            print("Detected Windows platform", file=sys.stderr)
-            ports = ports_win
+        for port in candidates:
+            real = os.path.realpath(port)  # links like /dev/ttyUSB_SQMsensor are the same device
+            if real not in seen:
+                seen.add(real)
+                ports.append(port)
+        print(f"Probing serial ports: {ports}", file=sys.stderr)
 
         used_port = None
-        for port in ports:
-            conn_test = serial.Serial(port, LU_BAUD, timeout=1)
-            conn_test.write("ix".encode(utf8))
-            if conn_test.readline().decode(utf8)[0] == "i":
-                used_port = port
-                break
+        if ports:
+            pool = futures.ThreadPoolExecutor(max_workers=8)
+            probes = [pool.submit(self._probe, port) for port in ports]
+            try:
+                for probe in futures.as_completed(probes, timeout=2.0):
+                    try:
+                        port = probe.result()
+                    except Exception as e:  # treat as a miss, keep checking the others
+                        print(f"Probe failed: {e}", file=sys.stderr)
+                        continue
+                    if port != None:
+                        used_port = port
+                        break
+            except futures.TimeoutError:
+                pass  # remaining ports didn't answer in time
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        if used_port == None:
+            print("ERR. Device not found!", file=sys.stderr)
+            raise ConnectionError("SQM-LU not found on any serial port")
+        return used_port
+
+    @staticmethod
+    def _probe(port: str) -> str | None:
+        """Checks whether the photometer is on the given port
 
+        Args:
+            port (str): serial port to try
+
+        Returns:
+            str | None: the port if the photometer answered, otherwise None
+        """
         try:
-            assert used_port != None
-        except:
-            print("ERR. Device not found!", file=sys.stderr)
-            raise
-        else:
-            return used_port
+            with serial.Serial(port, LU_BAUD, timeout=0.3) as conn_test:
+                conn_test.write(_enc("ix"))
+                if conn_test.readline().startswith(b"i"):
+                    return port
+        except (serial.SerialException, OSError):
+            pass  # port busy or not a photometer
+        return None
 
     def start_connection(self) -> None:
         """Start photometer connection"""
         self.s = serial.Serial(self.addr, LU_BAUD, timeout=lu_timeout)
+        self.line_buf = b""  # partial line, completed by a later read
+        self._register()
 
     def _close_connection(self) -> None:
         """End photometer connection"""
-        request = ""
-        r = True
-        while r:  # wait until device stops responding
-            r = self._read_buffer()
-            request += str(r)
+        self.s.timeout = 0.1  # don't wait lu_timeout on an idle device
+        self._drain()
+        self._unregister()
         self.s.close()
 
     def _read_buffer(self) -> bytes | None:
-        """Read the data"""
+        """Read whatever is waiting, store the complete lines
+
+        Returns:
+            bytes | None: complete lines read (b"" if only part of a line arrived), None if nothing was read
+        """
         m = None
         try:
-            m = self.s.readline()
-            if m.decode(utf8) == "":
+            chunk = self.s.read(self.s.in_waiting or 1)  # never waits once data is ready
+            if chunk == b"":
                 return
-            self.data.append(m.decode(utf8).strip())
+            self.line_buf += chunk
+            eol = _enc(EOL)
+            end = self.line_buf.rfind(eol)
+            if end == -1:  # no complete line yet
+                return b""
+            end += len(eol)
+            m, self.line_buf = self.line_buf[:end], self.line_buf[end:]
+            for line in m[: -len(eol)].split(eol):
+                self.data.append(line.strip())
         except:
             pass
         return m
 
-    def _send_command(self, s: str) -> None:
-        """SQM_LU sends a command to the sensor
+    def _read_response(self) -> bytes | None:
+        """Keeps reading until a complete line arrives or lu_timeout runs out, like readline() did
 
-        Args:
-            s (str): the command to send
+        Returns:
+            bytes | None: complete response line(s), b"" or None if the line never completed
         """
-        self.s.write(s.encode(utf8))
+        deadline = time.monotonic() + lu_timeout
+        m = self._read_buffer()
+        while m == b"" and time.monotonic() < deadline:  # partial line, wait for the rest
+            m = self._read_buffer()
+        return m
 
-    def send_and_receive(self, s: str, tries: int = tries) -> str:
-        """Deprecated way of sending a command and waiting for a response. However, there's no way to guarantee that the given response originated from the command that was sent.
+    def _send_command(self, s: str) -> None:
+        """SQM_LU sends a command to the sensor
 
         Args:
-            s (str): command to send
-            tries (int, optional): number of attempts to make. Defaults to tries.
-
-        Returns:
-            str: _description_
+            s (str): the command to send
         """
-        m: str = ""
-        self._send_command(s)
-        time.sleep(long_s)
-        byte_m = self._read_buffer()
-        try:  # Sanity check
-            assert byte_m != None
-            m = byte_m.decode(utf8)
-        except:
-            if tries <= 0:
-                print(
-                    ("ERR. Reading the photometer!: %s" % str(byte_m)), file=sys.stderr
-                )
-                if DEBUG:
-                    raise
-                return ""
-            time.sleep(mid_s)
-            self._reset_device()
-            time.sleep(mid_s)
-            m = self.send_and_receive(s, tries - 1)
-            print(("Sensor info: " + str(m)), end=" ", file=sys.stderr)
-        return m
+        self.s.write(_enc(s))
 
 
 if __name__ == "__main__":